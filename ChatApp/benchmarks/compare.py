@@ -0,0 +1,45 @@
+# Compares two load test result files.
+#
+#   python benchmarks/compare.py results/before.json results/after.json
+import argparse
+import json
+
+
+def change(before, after):
+    if not before or after is None:
+        return ""
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two load test results")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    rows = [
+        ("messages/s", before.get("messages_per_second"), after.get("messages_per_second")),
+        ("deliveries/s", before.get("deliveries_per_second"), after.get("deliveries_per_second")),
+        ("delivery ratio", before.get("delivery_ratio"), after.get("delivery_ratio")),
+        ("errors", before.get("errors"), after.get("errors")),
+    ]
+    for name in sorted(set(before.get("latency", {})) | set(after.get("latency", {}))):
+        for stat in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append((
+                f"{name} {stat}",
+                before.get("latency", {}).get(name, {}).get(stat),
+                after.get("latency", {}).get(name, {}).get(stat),
+            ))
+
+    print(f"{'metric':<32}{'before':>12}{'after':>12}{'change':>10}")
+    for name, old, new in rows:
+        print(f"{name:<32}{str(old):>12}{str(new):>12}{change(old, new):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# Load test for the socket and HTTP paths of the chat app.
+#
+#   python benchmarks/load_test.py --clients 200 --rooms 20 --duration 60
+#
+# Starts benchmarks/server.py (unless --url points at a running server),
+# registers the simulated users over HTTP, connects one Socket.IO client per
+# user and drives messages, typing, read receipts, history paging and unread
+# polling at the configured rates. Results are printed and saved as JSON so
+# runs can be compared with benchmarks/compare.py, the server's output is
+# saved next to them. Exits non-zero when too few messages were delivered.
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+import socketio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MESSAGE_PREFIX = "bench"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+def summarize(values):
+    """Count and latency percentiles in milliseconds"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3),
+    }
+
+
+def start_server(args, log_path):
+    command = [sys.executable, os.path.join(BENCH_DIR, "server.py"), "--port", str(args.port),
+               "--mongo-uri", args.mongo_uri]
+    if args.mongomock:
+        command.append("--mongomock")
+    env = dict(os.environ, MESSAGE_WRITE_MODE=args.write_mode)
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited during startup, see {log_path}")
+        try:
+            requests.get(f"{url}/login", timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Benchmark server did not start within 30 seconds")
+
+
+class SimulatedUser:
+    """One logged in user with a Socket.IO connection to their room"""
+
+    def __init__(self, url, username, metrics, rng):
+        self.url = url
+        self.username = username
+        self.metrics = metrics
+        self.rng = rng
+        self.http = requests.Session()
+        self.sio = socketio.Client(http_session=self.http, reconnection=False)
+        self.room = None
+        self.cursor = None
+        self.last_message_id = None
+        self.history_sent = None
+        self.connected = threading.Event()
+        self.sent = 0
+
+        self.sio.on("chat_history", self.on_chat_history)
+        self.sio.on("message", self.on_message)
+        self.sio.on("more_messages", self.on_more_messages)
+
+    def register(self):
+        data = {"username": self.username, "password": "benchmark1", "confirm_password": "benchmark1"}
+        self.http.post(f"{self.url}/register", data=data)
+        self.http.post(f"{self.url}/login", data={"username": self.username, "password": "benchmark1"})
+
+    def create_room(self, name):
+        self.http.post(f"{self.url}/", data={"create": "true", "room_name": name})
+        page = self.http.get(f"{self.url}/room/").text
+        match = re.search(r'data-room="([A-Z]+)"', page)
+        if not match:
+            raise RuntimeError(f"Could not create a room as {self.username}")
+        self.room = match.group(1)
+        return self.room
+
+    def join_room(self, code):
+        self.http.post(f"{self.url}/", data={"join": "true", "code": code})
+        self.room = code
+
+    def connect(self):
+        self.connect_started = time.perf_counter()
+        self.sio.connect(self.url, wait_timeout=30)
+
+    def on_chat_history(self, data):
+        self.metrics["connect"].append(time.perf_counter() - self.connect_started)
+        self.cursor = data.get("cursor")
+        if data.get("messages"):
+            self.last_message_id = data["messages"][-1]["id"]
+        self.connected.set()
+
+    def on_message(self, data):
+        self.last_message_id = data.get("id")
+        parts = str(data.get("message", "")).split(" ")
+        if len(parts) == 3 and parts[0] == MESSAGE_PREFIX:
+            self.metrics["delivery"].append(time.perf_counter() - float(parts[2]))
+
+    def on_more_messages(self, data):
+        if self.history_sent is not None:
+            self.metrics["load_more"].append(time.perf_counter() - self.history_sent)
+            self.history_sent = None
+        # Keep paging back, and start again from the newest page at the end
+        self.cursor = data.get("cursor") if data.get("has_more") else None
+
+    def send_message(self):
+        self.sent += 1
+        self.sio.emit("message", {"data": f"{MESSAGE_PREFIX} {self.sent} {time.perf_counter()}"})
+
+    def send_typing(self):
+        self.sio.emit("typing", {"isTyping": True})
+
+    def send_read_receipt(self):
+        if self.last_message_id:
+            self.sio.emit("mark_messages_read", {"message_ids": [self.last_message_id]})
+
+    def load_more(self):
+        if self.cursor and self.history_sent is None:
+            self.history_sent = time.perf_counter()
+            self.sio.emit("load_more_messages", {"before": self.cursor})
+
+    def poll_unread(self):
+        started = time.perf_counter()
+        response = self.http.get(f"{self.url}/get_unread_messages")
+        if response.ok:
+            self.metrics["get_unread_messages"].append(time.perf_counter() - started)
+        else:
+            self.metrics["errors"].append(f"get_unread_messages {response.status_code}")
+
+    def run(self, rates, stop_at):
+        """Fire actions as independent Poisson processes until stop_at"""
+        actions = {
+            "message": self.send_message,
+            "typing": self.send_typing,
+            "read": self.send_read_receipt,
+            "load_more": self.load_more,
+            "unread": self.poll_unread,
+        }
+        now = time.perf_counter()
+        next_at = {
+            name: now + self.rng.expovariate(rate)
+            for name, rate in rates.items() if rate > 0
+        }
+        while next_at:
+            name = min(next_at, key=next_at.get)
+            if next_at[name] >= stop_at:
+                break
+            delay = next_at[name] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                actions[name]()
+            except Exception as e:
+                self.metrics["errors"].append(f"{name}: {e}")
+            next_at[name] += self.rng.expovariate(rates[name])
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    metrics = {"connect": [], "delivery": [], "load_more": [], "get_unread_messages": [], "errors": []}
+    run_id = datetime.utcnow().strftime("%H%M%S") + str(rng.randrange(1000))
+
+    users = [
+        SimulatedUser(args.url, f"bench{run_id}_{i}", metrics, random.Random(rng.random()))
+        for i in range(args.clients)
+    ]
+    room_members = {}
+    for i, user in enumerate(users):
+        user.register()
+        room_index = i % args.rooms
+        if room_index not in room_members:
+            user.create_room(f"Benchmark room {room_index}")
+            room_members[room_index] = [user]
+        else:
+            user.join_room(room_members[room_index][0].room)
+            room_members[room_index].append(user)
+
+    # Give rooms some history so paging has something to read
+    for members in room_members.values():
+        members[0].connect()
+        members[0].connected.wait(30)
+        for _ in range(args.history):
+            members[0].sio.emit("message", {"data": "history"})
+    connect_started = time.perf_counter()
+    for user in users:
+        if not user.sio.connected:
+            user.connect()
+    for user in users:
+        if not user.connected.wait(30):
+            metrics["errors"].append(f"{user.username} got no chat history")
+    connect_seconds = time.perf_counter() - connect_started
+
+    rates = {
+        "message": args.message_rate,
+        "typing": args.typing_rate,
+        "read": args.read_rate,
+        "load_more": args.load_more_rate,
+        "unread": args.unread_rate,
+    }
+    started = time.perf_counter()
+    stop_at = started + args.duration
+    threads = [threading.Thread(target=user.run, args=(rates, stop_at), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # Let the last messages arrive before counting deliveries
+    time.sleep(args.drain)
+    for user in users:
+        user.sio.disconnect()
+
+    sent = sum(user.sent for user in users)
+    expected_deliveries = sum(user.sent * len(room_members[i % args.rooms]) for i, user in enumerate(users))
+    return {
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "connect_seconds": round(connect_seconds, 3),
+        "duration_seconds": round(elapsed, 3),
+        "messages_sent": sent,
+        "messages_per_second": round(sent / elapsed, 2),
+        "deliveries": len(metrics["delivery"]),
+        "deliveries_per_second": round(len(metrics["delivery"]) / elapsed, 2),
+        "delivery_ratio": round(len(metrics["delivery"]) / expected_deliveries, 4) if expected_deliveries else None,
+        "latency": {name: summarize(values) for name, values in metrics.items() if name != "errors"},
+        "errors": len(metrics["errors"]),
+        "error_samples": metrics["errors"][:20],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat app")
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongomock", action="store_true", help="run the server on an in-memory Mongo stand-in")
+    parser.add_argument("--write-mode", default="direct", choices=["direct", "commit", "enqueue"])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load after everyone is connected")
+    parser.add_argument("--history", type=int, default=50, help="messages written to each room before the run")
+    parser.add_argument("--message-rate", type=float, default=0.2, help="messages per client per second")
+    parser.add_argument("--typing-rate", type=float, default=0.5, help="typing events per client per second")
+    parser.add_argument("--read-rate", type=float, default=0.2, help="read receipts per client per second")
+    parser.add_argument("--load-more-rate", type=float, default=0.05, help="history pages per client per second")
+    parser.add_argument("--unread-rate", type=float, default=0.05, help="unread polls per client per second")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after the run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-delivery-ratio", type=float, default=0.95,
+                        help="fail the run when fewer of the expected deliveries arrive")
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", datetime.utcnow().strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    server_log = os.path.splitext(output)[0] + ".server.log"
+
+    server = None
+    if not args.url:
+        server, args.url = start_server(args, server_log)
+    try:
+        results = run_benchmark(args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{results['messages_sent']} messages, {results['messages_per_second']}/s sent, "
+          f"{results['deliveries_per_second']}/s delivered (ratio {results['delivery_ratio']}), "
+          f"{results['errors']} errors")
+    for name, summary in results["latency"].items():
+        if summary["count"]:
+            print(f"  {name:<20} n={summary['count']:<7} p50={summary['p50_ms']}ms "
+                  f"p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms")
+    print(f"Results saved to {output}")
+    if server:
+        print(f"Server output saved to {server_log}")
+
+    ratio = results["delivery_ratio"]
+    if ratio is not None and ratio < args.min_delivery_ratio:
+        print(f"Delivery ratio {ratio} is below {args.min_delivery_ratio}, the server dropped messages")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
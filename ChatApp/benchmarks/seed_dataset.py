@@ -0,0 +1,247 @@
+# Seeds MongoDB with a synthetic, production shaped dataset for capacity tests.
+#
+#   python benchmarks/seed_dataset.py --users 50000 --rooms 2000 --drop \
+#       --room-members pareto:1.3:3 --messages-per-room pareto:1.1:2000 --max-messages 1000000
+#
+# Documents match what register(), handle_room_operation(), message() and the
+# read receipt handlers write. Sizes are drawn from distributions given as
+# kind:a:b with kind one of
+#   fixed:N            always N
+#   uniform:LOW:HIGH   uniform between LOW and HIGH
+#   lognormal:MU:SIGMA exp of a normal distribution
+#   pareto:ALPHA:MIN   long tailed, MIN scaled pareto
+# and the same --seed always produces the same data. Everything is written
+# with unordered bulk inserts. Start the app afterwards to build its indexes.
+import argparse
+import random
+import time
+from array import array
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import MongoClient
+from werkzeug.security import generate_password_hash
+
+WORDS = (
+    "the a to and is it you that in of for on we this be have are do not with can what so just "
+    "homework test quiz class teacher lunch tomorrow today tonight game practice bus meet "
+    "yes no maybe lol ok sure thanks why how when where who going gonna later now here there"
+).split()
+EMOJIS = ["👍", "❤️", "😂", "😮", "😢", "🔥"]
+
+
+def sampler(spec):
+    """Build a function drawing one positive integer from a distribution spec"""
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+    if kind == "fixed":
+        return lambda rng: int(params[0])
+    if kind == "uniform":
+        return lambda rng: int(rng.uniform(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda rng: int(rng.lognormvariate(params[0], params[1]))
+    if kind == "pareto":
+        return lambda rng: int(params[1] * rng.paretovariate(params[0]))
+    raise argparse.ArgumentTypeError(f"Unknown distribution: {spec}")
+
+
+class BulkWriter:
+    """Buffers documents and writes them with unordered insert_many calls"""
+
+    def __init__(self, collection, batch_size):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.buffer = []
+        self.written = 0
+
+    def add(self, doc):
+        self.buffer.append(doc)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.collection.insert_many(self.buffer, ordered=False, bypass_document_validation=True)
+            self.written += len(self.buffer)
+            self.buffer = []
+
+
+def message_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(max(1, int(rng.lognormvariate(1.8, 0.7)))))
+
+
+def build_friends(rng, user_count, friend_sampler):
+    """Random symmetric friend graph, friends per user drawn from friend_sampler"""
+    friends = [set() for _ in range(user_count)]
+    for user in range(user_count):
+        wanted = min(friend_sampler(rng), user_count - 1)
+        while len(friends[user]) < wanted:
+            friend = rng.randrange(user_count)
+            if friend != user:
+                friends[user].add(friend)
+                friends[friend].add(user)
+    return friends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a synthetic chat dataset")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="chat_app_db")
+    parser.add_argument("--drop", action="store_true", help="drop the app's collections first")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--friends", type=sampler, default="lognormal:4:0.8", help="friends per user")
+    parser.add_argument("--room-members", type=sampler, default="pareto:1.5:3", help="members per room")
+    parser.add_argument("--messages-per-room", type=sampler, default="pareto:1.2:200")
+    parser.add_argument("--max-messages", type=int, default=1000000, help="cap on messages in one room")
+    parser.add_argument("--large-room-members", type=int, default=1000,
+                        help="rooms with at least this many members are created as large rooms")
+    parser.add_argument("--days", type=int, default=365, help="how far back message history goes")
+    parser.add_argument("--reaction-rate", type=float, default=0.05, help="share of messages with reactions")
+    parser.add_argument("--reply-rate", type=float, default=0.05, help="share of messages that are replies")
+    parser.add_argument("--caught-up-rate", type=float, default=0.7,
+                        help="share of members who have read everything in a room")
+    parser.add_argument("--invite-rate", type=float, default=0.1, help="share of users with pending room invites")
+    parser.add_argument("--request-rate", type=float, default=0.2, help="share of users with pending friend requests")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    db = MongoClient(args.mongo_uri)[args.database]
+    if args.drop:
+        for name in ("users", "rooms", "messages", "read_state", "message_archive"):
+            db.drop_collection(name)
+
+    started = time.monotonic()
+    usernames = [f"user{index:07d}" for index in range(args.users)]
+    # Hashing is slow on purpose, every seeded user shares the password "password1"
+    password_hash = generate_password_hash("password1")
+
+    print("Building friend graph")
+    friends = build_friends(rng, args.users, args.friends)
+
+    print("Writing rooms, messages and read state")
+    room_codes = set()
+    memberships = [[] for _ in range(args.users)]
+    rooms = BulkWriter(db["rooms"], args.batch_size)
+    messages = BulkWriter(db["messages"], args.batch_size)
+    read_state = BulkWriter(db["read_state"], args.batch_size)
+    started_at = time.time()
+    counter = rng.randrange(1 << 40)
+
+    for _ in range(args.rooms):
+        code = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(10))
+        while code in room_codes:
+            code = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(10))
+        room_codes.add(code)
+
+        member_count = max(1, min(args.room_members(rng), args.users))
+        members = rng.sample(range(args.users), member_count)
+        for member in members:
+            memberships[member].append(code)
+        large = member_count >= args.large_room_members
+        room = {
+            "_id": code,
+            "name": " ".join(rng.choice(WORDS) for _ in range(2)).title(),
+            "users": [usernames[members[0]]] if large else [usernames[member] for member in members],
+            "created_by": usernames[members[0]],
+            "member_count": member_count,
+            "last_message": None,
+        }
+        if large:
+            room.update(large=True, online_count=0)
+
+        # Messages are spread over the history window, oldest first. They must
+        # all stay in the past, the app orders messages and read watermarks by
+        # _id and a future ObjectId sorts after everything written later
+        message_count = min(args.messages_per_room(rng), args.max_messages)
+        senders = array("I")
+        message_ids = []
+        timestamps = sorted(
+            rng.uniform(started_at - args.days * 86400, started_at)
+            for _ in range(message_count)
+        )
+        for timestamp in timestamps:
+            counter += 1
+            message_id = ObjectId(int(timestamp).to_bytes(4, "big") + counter.to_bytes(8, "big"))
+            sender = members[min(int(rng.paretovariate(1.2)) - 1, member_count - 1)]
+            senders.append(sender)
+            message_ids.append(message_id)
+            message = {
+                "_id": message_id,
+                "id": str(message_id),
+                "name": usernames[sender],
+                "message": message_text(rng),
+                "reply_to": None,
+                "room": code,
+                "seq": len(message_ids),
+                "rev": len(message_ids),
+                "created_at": datetime.utcfromtimestamp(timestamp),
+            }
+            if message_ids[:-1] and rng.random() < args.reply_rate:
+                replied = rng.randrange(max(0, len(message_ids) - 50), len(message_ids) - 1)
+                message["reply_to"] = {"id": str(message_ids[replied]), "message": message_text(rng)}
+            if rng.random() < args.reaction_rate:
+                message["reactions"] = {
+                    emoji: 1 + int(rng.expovariate(0.5))
+                    for emoji in rng.sample(EMOJIS, min(1 + int(rng.expovariate(1.5)), len(EMOJIS)))
+                }
+            messages.add(message)
+        room["seq"] = room["rev"] = message_count
+        if message_count:
+            # Same shape as message_summary() in main.py
+            room["last_message"] = {
+                "id": message["id"],
+                "name": message["name"],
+                "preview": message["message"][:100],
+                "created_at": message["created_at"],
+            }
+        rooms.add(room)
+
+        # Most members are caught up, the rest are a little way behind
+        for member in members:
+            behind = 0 if rng.random() < args.caught_up_rate else min(int(rng.expovariate(0.05)) + 1, message_count)
+            state = {"room": code, "username": usernames[member], "unread": 0}
+            if message_count and behind < message_count:
+                state["last_read"] = message_ids[message_count - behind - 1]
+                state["last_read_seq"] = message_count - behind
+            if not large:
+                state["unread"] = sum(1 for sender in senders[message_count - behind:] if sender != member)
+            read_state.add(state)
+
+    rooms.flush()
+    messages.flush()
+    read_state.flush()
+
+    print("Writing users")
+    users = BulkWriter(db["users"], args.batch_size)
+    all_rooms = list(room_codes)
+    for index, username in enumerate(usernames):
+        user = {
+            "username": username,
+            "password": password_hash,
+            "friends": [usernames[friend] for friend in friends[index]],
+            "friend_requests": [],
+            "current_room": None,
+            "online": False,
+            "rooms": memberships[index],
+        }
+        if rng.random() < args.request_rate:
+            user["friend_requests"] = [usernames[rng.randrange(args.users)] for _ in range(1 + int(rng.expovariate(0.5)))]
+        if rng.random() < args.invite_rate and all_rooms:
+            user["room_invites"] = [
+                {"room": rng.choice(all_rooms), "from": usernames[rng.randrange(args.users)]}
+                for _ in range(1 + int(rng.expovariate(1)))
+            ]
+        users.add(user)
+    users.flush()
+
+    elapsed = time.monotonic() - started
+    print(f"Seeded {users.written} users, {rooms.written} rooms, {messages.written} messages "
+          f"and {read_state.written} read states in {elapsed:.1f}s "
+          f"({messages.written / max(elapsed, 1e-9):,.0f} messages/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Starts the chat app for benchmarks, without the debugger and reloader.
+#
+#   python benchmarks/server.py --port 5055 --mongo-uri mongodb://localhost:27017
+#
+# --mongomock runs against an in-memory Mongo stand-in instead (pip install
+# mongomock), handy for smoke runs but not for numbers you want to compare.
+import argparse
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server for benchmarking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory Mongo stand-in")
+    args = parser.parse_args()
+
+    # Push notifications are accepted but never sent, and sessions work over plain http
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ.setdefault("PUSH_BACKEND", "stub")
+    os.environ.setdefault("SESSION_COOKIE_SECURE", "0")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ENABLE_SCHEDULER", "0")
+
+    if args.mongomock:
+        import mongomock
+        import mongomock.collection
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+        # pymongo 4 passes sort= to bulk UpdateOne operations, which mongomock
+        # doesn't accept yet
+        add_update = mongomock.collection.BulkOperationBuilder.add_update
+        mongomock.collection.BulkOperationBuilder.add_update = (
+            lambda self, *a, sort=None, **kw: add_update(self, *a, **kw)
+        )
+
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    from main import app, socketio
+
+    socketio.run(app, host=args.host, port=args.port, debug=False, use_reloader=False,
+                 allow_unsafe_werkzeug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 // Constants and DOM elements
 const TYPING_TIMEOUT = 1000;
+const TYPING_REFRESH = 3000; // Must stay below the server's typing timeout
+const GAP_GRACE = 1000; // Time a message that arrived out of order gets before it is fetched
 const messages = document.getElementById("messages");
 const messageInput = document.getElementById("message");
 const imageUpload = document.getElementById('image-upload');
 const leaveRoomButton = document.getElementById("leave-room-btn");
 const username = document.getElementById("username").value;
 const unreadMessages = new Set();
+const roomUsers = new Map();
+const userListElement = document.getElementById('user-list');
+const isLargeRoom = userListElement.dataset.large === 'true';
 const originalTitle = document.title;
 
 // State variables
@@ -13,13 +18,23 @@ let replyingTo = null;
 let isUserListVisible = false;
 let typingTimeout;
 let currentUser = null;
-let typingUsers = new Set();
+let typingUsers = [];
+let typingCount = 0;
+let isTyping = false;
+let lastTypingSent = 0;
 let lastReadMessageId = null;
 let isTabActive = true;
 let unreadCount = 0;
+let onlineCount = 0;
+let memberCursor = null;
+let hasMoreMembers = isLargeRoom;
+let isLoadingMembers = false;
 let hasMoreMessages = false;
 let isLoadingMessages = false;
-let oldestMessageId = null;
+let oldestCursor = null;
+let lastRev = 0; // Newest change to the room's messages this page has seen
+let lastSeq = 0; // Highest message sequence number this page has seen
+let gapCheck = null;
 
 //Local Storage
 const LS_KEYS = {
@@ -28,8 +43,16 @@ const LS_KEYS = {
   USERNAME: 'username',
 };
 
+// Newest message on the page, reconnects only ask for what changed after it
+const newestMessageId = () => {
+  const rendered = messages.querySelectorAll('[data-message-id]');
+  return rendered.length ? rendered[rendered.length - 1].dataset.messageId : null;
+};
+
 var socketio = io({
-  transports: ['websocket']  // Ensure only WebSocket is used
+  transports: ['websocket'],  // Ensure only WebSocket is used
+  // Read again on every reconnect so the server can send only what was missed
+  auth: (cb) => cb({ room: userListElement.dataset.room, last_rev: lastRev, last_id: newestMessageId() })
 });
 
 // Helper functions
@@ -88,7 +111,7 @@ document.addEventListener("visibilitychange", handleVisibilityChange);
 
 const typingIndicator = createTypingIndicator();
 
-const createMessageElement = (name, msg, image, messageId, replyTo) => {
+const createMessageElement = (name, msg, image, messageId, replyTo, imageWidths) => {
   const isCurrentUser = name === currentUser;
 
   const element = document.createElement("div");
@@ -130,7 +153,22 @@ const createMessageElement = (name, msg, image, messageId, replyTo) => {
   // Image
   if (image) {
     const img = document.createElement("img");
-    img.src = image;
+    if (image.startsWith('/images/')) {
+      // Let the browser pick the smallest variant that fits the bubble
+      img.src = `${image}?size=medium`;
+      // Describe each variant by its real width, portrait images are narrower
+      // than their longest side
+      const widths = imageWidths || { thumb: 320, medium: 1024 };
+      img.srcset = ["thumb", "medium"]
+        .filter((size) => widths[size])
+        .map((size) => `${image}?size=${size} ${widths[size]}w`)
+        .join(", ");
+      img.sizes = "(max-width: 768px) 85vw, 480px";
+      img.loading = "lazy";
+      img.addEventListener('click', () => window.open(`${image}?size=original`, '_blank'));
+    } else {
+      img.src = image;
+    }
     img.alt = "Uploaded image";
     img.className = "mt-2 max-w-full rounded-lg";
     messageBubble.appendChild(img);
@@ -202,8 +240,14 @@ const addMessageToDOM = (element) => {
     messages.appendChild(messageContainer);
   }
   
-  // Always append new messages to the end of the container
-  messageContainer.appendChild(element);
+  // New messages go at the end, unless one that was missed arrives late
+  const later = element.dataset.seq && Array.from(messageContainer.querySelectorAll(':scope > [data-seq]'))
+    .find(other => Number(other.dataset.seq) > Number(element.dataset.seq));
+  if (later) {
+    messageContainer.insertBefore(element, later);
+  } else {
+    messageContainer.appendChild(element);
+  }
   
   messages.scrollTop = messages.scrollHeight;
 
@@ -250,7 +294,29 @@ const addReaction = (messageId, emoji) => {
   socketio.emit('add_reaction', { messageId, emoji });
 };
 
+const updateReactions = (messageId, reactions) => {
+  const messageElement = document.querySelector(`[data-message-id="${messageId}"]`);
+  if (!messageElement) return;
+
+  let reactionsContainer = messageElement.querySelector('.reactions');
+  if (!reactionsContainer) {
+    reactionsContainer = document.createElement('div');
+    reactionsContainer.className = 'reactions flex gap-1 mt-1 text-sm';
+    messageElement.appendChild(reactionsContainer);
+  }
+  reactionsContainer.innerHTML = '';
+  Object.entries(reactions || {}).forEach(([emoji, count]) => {
+    const reaction = document.createElement('span');
+    reaction.className = 'reaction';
+    reaction.setAttribute('data-emoji', emoji);
+    reaction.setAttribute('data-count', count);
+    reaction.textContent = `${emoji} ${count}`;
+    reactionsContainer.appendChild(reaction);
+  });
+};
+
 socketio.on('update_reactions', (data) => {
+  lastRev = Math.max(lastRev, data.rev || 0);
   updateReactions(data.messageId, data.reactions);
 });
 
@@ -300,19 +366,19 @@ const editMessage = (messageId) => {
 };
 
 const updateTypingIndicator = () => {
-  const typingArray = Array.from(typingUsers);
+  const typingArray = typingUsers;
   let typingText = '';
 
-  if (typingArray.length === 1) {
+  if (typingCount === 1) {
     typingText = `${typingArray[0]} is typing...`;
-  } else if (typingArray.length === 2) {
+  } else if (typingCount === 2) {
     typingText = `${typingArray[0]} and ${typingArray[1]} are typing...`;
-  } else if (typingArray.length > 2) {
-    typingText = `${typingArray[0]}, ${typingArray[1]}, and ${typingArray.length - 2} more are typing...`;
+  } else if (typingCount > 2) {
+    typingText = `${typingArray[0]}, ${typingArray[1]}, and ${typingCount - 2} more are typing...`;
   }
 
   typingIndicator.textContent = typingText;
-  typingIndicator.style.display = typingArray.length > 0 ? "block" : "none";
+  typingIndicator.style.display = typingCount > 0 ? "block" : "none";
 };
 
 const deleteMessage = (messageId) => {
@@ -330,6 +396,10 @@ const sendMessage = () => {
     replyTo: replyingTo
   };
   socketio.emit("message", messageData);
+
+  // The server stops our typing state when the message arrives
+  clearTimeout(typingTimeout);
+  isTyping = false;
 };
 
 const leaveRoom = () => {
@@ -342,9 +412,16 @@ messageInput.addEventListener("keyup", (event) => {
   if (event.key === "Enter") {
     sendMessage();
   } else {
-    socketio.emit("typing", { isTyping: true });
+    // Only tell the server when we start or stop typing, plus a refresh
+    // now and then so it doesn't expire us while we keep typing
+    if (!isTyping || Date.now() - lastTypingSent > TYPING_REFRESH) {
+      isTyping = true;
+      lastTypingSent = Date.now();
+      socketio.emit("typing", { isTyping: true });
+    }
     clearTimeout(typingTimeout);
     typingTimeout = setTimeout(() => {
+      isTyping = false;
       socketio.emit("typing", { isTyping: false });
     }, TYPING_TIMEOUT);
   }
@@ -353,11 +430,19 @@ messageInput.addEventListener("keyup", (event) => {
 imageUpload.addEventListener('change', (event) => {
   const file = event.target.files[0];
   if (file) {
-    const reader = new FileReader();
-    reader.onload = (e) => {
-      socketio.emit("message", { data: "Sent an image", image: e.target.result });
-    };
-    reader.readAsDataURL(file);
+    const formData = new FormData();
+    formData.append('image', file);
+
+    // Upload the raw file first, then send a message referencing it
+    fetch('/upload_image', { method: 'POST', body: formData })
+      .then(response => response.ok ? response.json() : Promise.reject(response))
+      .then(data => {
+        socketio.emit("message", { data: "Sent an image", image_id: data.id });
+      })
+      .catch(error => console.error('Error uploading image:', error))
+      .finally(() => {
+        imageUpload.value = '';
+      });
   }
 });
 
@@ -392,17 +477,19 @@ const markMessagesAsRead = () => {
   }
 };
 
-socketio.on("message", (data) => {
+const appendMessage = (data) => {
   const messageElement = createMessageElement(
     data.name, 
     data.message, 
     data.image, 
     data.id, 
-    data.reply_to
+    data.reply_to,
+    data.image_widths
   );
+  if (data.seq) messageElement.dataset.seq = data.seq;
   addMessageToDOM(messageElement);
 
-  if (data.name !== currentUser) {
+  if (data.name !== currentUser && !(data.read_by || []).includes(currentUser)) {
     unreadMessages.add(data.id);
     if (isTabActive) {
       markMessagesAsRead();
@@ -418,9 +505,6 @@ socketio.on("message", (data) => {
   }
 
   if (data.name === currentUser) {
-    messageInput.value = "";
-    cancelReply();
-
     const editBtn = messageElement.querySelector('.edit-btn');
     const deleteBtn = messageElement.querySelector('.delete-btn');
     editBtn.addEventListener('click', () => editMessage(data.id));
@@ -429,6 +513,67 @@ socketio.on("message", (data) => {
     const replyBtn = messageElement.querySelector('.reply-btn');
     replyBtn.addEventListener('click', () => startReply(data.id, data.message));
   }
+  return messageElement;
+};
+
+// Sequence numbers go up by one per message in a room, a jump means a
+// broadcast was missed or is late, so fetch the gap if it isn't filled soon
+const checkSequence = (seq) => {
+  if (!seq) return;
+  if (seq > lastSeq + 1 && lastSeq > 0 && !gapCheck) {
+    const after = lastSeq;
+    gapCheck = setTimeout(() => {
+      gapCheck = null;
+      for (let missing = after + 1; missing < seq; missing++) {
+        if (!messages.querySelector(`[data-seq="${missing}"]`)) {
+          socketio.emit("fetch_missed_messages", { after, before: seq });
+          return;
+        }
+      }
+    }, GAP_GRACE);
+  }
+  lastSeq = Math.max(lastSeq, seq);
+};
+
+socketio.on("missed_messages", (data) => {
+  data.messages.forEach((message) => {
+    if (!document.querySelector(`[data-message-id="${message.id}"]`)) {
+      appendMessage(message);
+    }
+  });
+  markMessagesAsRead();
+});
+
+socketio.on("message", (data) => {
+  lastRev = Math.max(lastRev, data.rev || 0);
+  checkSequence(data.seq);
+  appendMessage(data);
+
+  if (data.name === currentUser) {
+    messageInput.value = "";
+    cancelReply();
+  }
+});
+
+// Sent instead of chat_history on a reconnect, with every message that was
+// sent, edited, reacted to or deleted while this page was disconnected
+socketio.on("sync_delta", (data) => {
+  data.messages.forEach((message) => {
+    const messageElement = document.querySelector(`[data-message-id="${message.id}"]`);
+    if (message.deleted) {
+      if (messageElement) messageElement.remove();
+    } else if (messageElement) {
+      messageElement.querySelector('.message-content').textContent = message.message;
+      updateReactions(message.id, message.reactions);
+    } else if (!message.seq || message.seq > lastSeq) {
+      // Changes to older messages that aren't loaded are skipped
+      appendMessage(message);
+      if (message.reactions) updateReactions(message.id, message.reactions);
+    }
+  });
+  lastRev = Math.max(lastRev, data.rev);
+  lastSeq = Math.max(lastSeq, data.seq || 0);
+  markMessagesAsRead();
 });
 
 socketio.on("messages_read", (data) => {
@@ -451,8 +596,10 @@ socketio.on("chat_history", (data) => {
       message.message, 
       message.image, 
       message.id, 
-      message.reply_to
+      message.reply_to,
+      message.image_widths
     );
+    if (message.seq) messageElement.dataset.seq = message.seq;
     messageContainer.appendChild(messageElement);
 
     if (message.name !== currentUser && !message.read_by.includes(currentUser)) {
@@ -467,9 +614,11 @@ socketio.on("chat_history", (data) => {
   messages.innerHTML = '';
   messages.appendChild(messageContainer);
   
-  if (data.messages.length > 0) {
-    oldestMessageId = data.messages[0].id;
+  if (data.cursor) {
+    oldestCursor = data.cursor;
   }
+  lastRev = data.rev || 0;
+  lastSeq = data.seq || 0;
   
   hasMoreMessages = data.has_more;
   updateLoadMoreButton();
@@ -502,8 +651,10 @@ socketio.on("more_messages", (data) => {
       message.message, 
       message.image, 
       message.id, 
-      message.reply_to
+      message.reply_to,
+      message.image_widths
     );
+    if (message.seq) messageElement.dataset.seq = message.seq;
     fragment.appendChild(messageElement);
 
     if (message.name !== currentUser && !message.read_by.includes(currentUser)) {
@@ -522,8 +673,8 @@ socketio.on("more_messages", (data) => {
     messageContainer.insertBefore(fragment, messageContainer.firstChild);
   }
   
-  if (data.messages.length > 0) {
-    oldestMessageId = data.messages[0].id;
+  if (data.cursor) {
+    oldestCursor = data.cursor;
   }
   
   hasMoreMessages = data.has_more;
@@ -570,10 +721,11 @@ function loadMoreMessages() {
   if (isLoadingMessages || !hasMoreMessages) return;
   
   isLoadingMessages = true;
-  socketio.emit("load_more_messages", { last_message_id: oldestMessageId });
+  socketio.emit("load_more_messages", { before: oldestCursor });
 }
 
 socketio.on("edit_message", (data) => {
+  lastRev = Math.max(lastRev, data.rev || 0);
   const messageElement = document.querySelector(`[data-message-id="${data.messageId}"]`);
   if (messageElement) {
     const messageContent = messageElement.querySelector('.message-content');
@@ -584,18 +736,17 @@ socketio.on("edit_message", (data) => {
 });
   
 socketio.on("delete_message", (data) => {
+  lastRev = Math.max(lastRev, data.rev || 0);
   const messageElement = document.querySelector(`[data-message-id="${data.messageId}"]`);
   if (messageElement) {
     messageElement.remove();
   }
 });
 
-socketio.on("typing", (data) => {
-  if (data.isTyping) {
-    typingUsers.add(data.name);
-  } else {
-    typingUsers.delete(data.name);
-  }
+// Everyone typing in the room, sent by the server at most once per interval
+socketio.on("typing_users", (data) => {
+  typingUsers = data.users.filter(name => name !== username);
+  typingCount = data.count - (data.users.includes(username) ? 1 : 0);
   updateTypingIndicator();
 });
 
@@ -608,6 +759,86 @@ socketio.on("disconnect", () => {
   console.log("Disconnected from server");
 });
 
+const renderUserList = () => {
+  const userListContainer = document.querySelector('#user-list > div');
+  const userCountLabel = document.getElementById('user-count-label');
+  const users = Array.from(roomUsers.values());
+
+  userListContainer.innerHTML = '';
+  users.forEach(user => {
+    const entry = document.createElement('div');
+    entry.className = 'flex items-center justify-between px-2 py-1 text-sm text-gray-800 dark:text-gray-200';
+
+    const name = document.createElement('span');
+    name.textContent = user.isFriend ? `${user.username} (friend)` : user.username;
+
+    const status = document.createElement('span');
+    status.className = `w-2 h-2 rounded-full ${user.online ? 'bg-green-500' : 'bg-gray-400'}`;
+
+    entry.appendChild(name);
+    entry.appendChild(status);
+    userListContainer.appendChild(entry);
+  });
+
+  if (isLargeRoom) {
+    if (hasMoreMembers) {
+      const loadMoreButton = document.createElement('button');
+      loadMoreButton.className = 'w-full px-2 py-1 text-sm text-indigo-600 dark:text-indigo-400 hover:underline';
+      loadMoreButton.textContent = 'Load more members';
+      loadMoreButton.addEventListener('click', loadMemberPage);
+      userListContainer.appendChild(loadMoreButton);
+    }
+    userCountLabel.textContent = `${onlineCount} Online`;
+  } else {
+    userCountLabel.textContent = `${users.filter(user => user.online).length} Online`;
+  }
+};
+
+// Large rooms send counts only, members are fetched one page at a time
+const loadMemberPage = async () => {
+  if (isLoadingMembers || !hasMoreMembers) return;
+  isLoadingMembers = true;
+
+  const params = new URLSearchParams();
+  if (memberCursor) params.set('after', memberCursor);
+
+  try {
+    const response = await fetch(`/room/${userListElement.dataset.room}/members?${params}`);
+    if (!response.ok) throw new Error(`Member request failed with ${response.status}`);
+    const data = await response.json();
+    data.members.forEach(user => roomUsers.set(user.username, user));
+    memberCursor = data.next;
+    hasMoreMembers = data.next !== null;
+    renderUserList();
+  } catch (error) {
+    console.error("Error loading members:", error);
+  } finally {
+    isLoadingMembers = false;
+  }
+};
+
+// Full member list, only sent to us when we connect
+socketio.on("update_users", (data) => {
+  roomUsers.clear();
+  data.users.forEach(user => roomUsers.set(user.username, user));
+  if (data.large) {
+    onlineCount = data.online_count;
+    memberCursor = null;
+    hasMoreMembers = true;
+  }
+  renderUserList();
+});
+
+// Merged member changes from the rest of the room
+socketio.on("users_delta", (data) => {
+  data.updated.forEach(user => {
+    roomUsers.set(user.username, { ...roomUsers.get(user.username), ...user });
+  });
+  data.left.forEach(username => roomUsers.delete(username));
+  if (data.online_count !== undefined) onlineCount = data.online_count;
+  renderUserList();
+});
+
 document.querySelector('.user-toggle-btn').addEventListener('click', () => {
   const userList = document.getElementById('user-list');
   const userCountLabel = document.getElementById('user-count-label');
@@ -618,6 +849,7 @@ document.querySelector('.user-toggle-btn').addEventListener('click', () => {
   } else {
     userList.classList.remove('hidden');
     userCountLabel.classList.add('hidden');
+    if (isLargeRoom && roomUsers.size === 0) loadMemberPage();
   }
   
   isUserListVisible = !isUserListVisible;
@@ -0,0 +1,35 @@
+# Imports the app against an in-memory Mongo stand-in (pip install pytest mongomock),
+# the same way benchmarks/server.py --mongomock does.
+import os
+import sys
+
+import mongomock
+import mongomock.collection
+import pymongo
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("PUSH_BACKEND", "stub")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ENABLE_SCHEDULER", "0")
+os.environ.setdefault("SESSION_COOKIE_SECURE", "0")
+pymongo.MongoClient = mongomock.MongoClient
+
+# pymongo 4 passes sort= to bulk UpdateOne operations, which mongomock doesn't accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+mongomock.collection.BulkOperationBuilder.add_update = (
+    lambda self, *a, sort=None, **kw: _add_update(self, *a, **kw)
+)
+os.chdir(APP_DIR)
+sys.path.insert(0, APP_DIR)
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def app_main():
+    """The app module with empty collections"""
+    for collection in (main.users_collection, main.rooms_collection, main.messages_collection):
+        collection.delete_many({})
+    return main
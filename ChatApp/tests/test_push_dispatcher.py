@@ -0,0 +1,138 @@
+from types import SimpleNamespace
+
+import pytest
+from firebase_admin import exceptions, messaging
+
+
+class FakeMessagingBackend:
+    """Records every multicast and answers each token from a script of errors.
+
+    errors maps a token to the firebase_admin exception classes of its
+    successive attempts, a token succeeds once its errors run out.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = {token: list(classes) for token, classes in (errors or {}).items()}
+        self.sent = []
+
+    @staticmethod
+    def Notification(**kwargs):
+        return kwargs
+
+    @staticmethod
+    def MulticastMessage(**kwargs):
+        return kwargs
+
+    def send_each_for_multicast(self, message):
+        self.sent.append(list(message["tokens"]))
+        responses = []
+        for token in message["tokens"]:
+            errors = self.errors.get(token)
+            if errors:
+                error = errors.pop(0)("push failed")
+                responses.append(SimpleNamespace(success=False, exception=error))
+            else:
+                responses.append(SimpleNamespace(success=True, exception=None))
+        return SimpleNamespace(responses=responses)
+
+
+@pytest.fixture
+def sleeps(app_main, monkeypatch):
+    delays = []
+    monkeypatch.setattr(app_main.time, "sleep", delays.append)
+    return delays
+
+
+def add_members(app_main, room, tokens):
+    app_main.users_collection.insert_many([
+        {"username": f"user{index}", "rooms": [room], "fcm_token": token}
+        for index, token in enumerate(tokens)
+    ])
+
+
+def dispatcher(app_main, backend, **kwargs):
+    return app_main.PushDispatcher(backend=backend, **kwargs)
+
+
+def test_sends_to_room_members_but_the_sender(app_main, sleeps):
+    add_members(app_main, "ROOM", ["a", "b", None, ""])
+    app_main.users_collection.insert_one({"username": "sender", "rooms": ["ROOM"], "fcm_token": "s"})
+    backend = FakeMessagingBackend()
+
+    dispatcher(app_main, backend).dispatch("ROOM", "sender", {"name": "sender", "message": "hi"})
+
+    assert backend.sent == [["a", "b"]]
+    assert sleeps == []
+
+
+def test_batches_tokens_at_the_multicast_limit(app_main, sleeps):
+    tokens = [f"token{index}" for index in range(1201)]
+    add_members(app_main, "ROOM", tokens)
+    backend = FakeMessagingBackend()
+
+    dispatcher(app_main, backend).dispatch("ROOM", "nobody", {"name": "x", "message": "hi"})
+
+    assert [len(batch) for batch in backend.sent] == [500, 500, 201]
+    assert sorted(sum(backend.sent, [])) == sorted(tokens)
+
+
+def test_retries_only_failed_tokens_with_backoff(app_main, sleeps):
+    add_members(app_main, "ROOM", ["a", "b", "c"])
+    backend = FakeMessagingBackend({"b": [exceptions.UnavailableError, exceptions.InternalError]})
+
+    dispatcher(app_main, backend, retry_delay=0.5).dispatch("ROOM", "nobody", {"name": "x", "message": "hi"})
+
+    assert backend.sent == [["a", "b", "c"], ["b"], ["b"]]
+    assert sleeps == [0.5, 1.0]
+
+
+def test_gives_up_after_max_retries(app_main, sleeps):
+    add_members(app_main, "ROOM", ["a"])
+    backend = FakeMessagingBackend({"a": [exceptions.UnavailableError] * 10})
+
+    dispatcher(app_main, backend, max_retries=3, retry_delay=0.5).dispatch(
+        "ROOM", "nobody", {"name": "x", "message": "hi"}
+    )
+
+    assert len(backend.sent) == 4
+    assert sleeps == [0.5, 1.0, 2.0]
+
+
+def test_prunes_invalid_tokens(app_main, sleeps):
+    add_members(app_main, "ROOM", ["good", "gone", "other"])
+    backend = FakeMessagingBackend({
+        "gone": [messaging.UnregisteredError],
+        "other": [messaging.SenderIdMismatchError],
+    })
+
+    dispatcher(app_main, backend).dispatch("ROOM", "nobody", {"name": "x", "message": "hi"})
+
+    remaining = {user["username"]: user.get("fcm_token") for user in app_main.users_collection.find()}
+    assert remaining == {"user0": "good", "user1": None, "user2": None}
+    assert backend.sent == [["good", "gone", "other"]]
+
+
+def test_keeps_tokens_on_errors_that_are_not_about_the_token(app_main, sleeps):
+    add_members(app_main, "ROOM", ["a", "b", "c"])
+    backend = FakeMessagingBackend({
+        "a": [exceptions.InvalidArgumentError],
+        "b": [exceptions.PermissionDeniedError],
+        "c": [exceptions.NotFoundError],
+    })
+
+    dispatcher(app_main, backend).dispatch("ROOM", "nobody", {"name": "x", "message": "hi"})
+
+    assert backend.sent == [["a", "b", "c"]]
+    assert [user["fcm_token"] for user in app_main.users_collection.find()] == ["a", "b", "c"]
+
+
+def test_truncates_long_message_bodies(app_main, sleeps):
+    add_members(app_main, "ROOM", ["a"])
+    backend = FakeMessagingBackend()
+    messages = []
+    backend.MulticastMessage = lambda **kwargs: messages.append(kwargs) or kwargs
+    push = dispatcher(app_main, backend)
+
+    push.dispatch("ROOM", "nobody", {"name": "x", "message": "y" * 5000})
+
+    assert messages[0]["notification"]["body"] == "y" * push.BODY_LENGTH
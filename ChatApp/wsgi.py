@@ -0,0 +1,18 @@
+# Production entry point, runs the app on eventlet so one process can hold
+# many websocket connections. Start one worker per process:
+#
+#   gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:5001 wsgi:app
+#
+# To use several processes or machines, point all of them at the same Redis
+# with SOCKETIO_MESSAGE_QUEUE and put them behind a load balancer.
+import eventlet
+eventlet.monkey_patch()
+
+import os
+
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "eventlet")
+
+from main import app, socketio  # noqa: E402
+
+if __name__ == "__main__":
+    socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5001)))